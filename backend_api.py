@@ -1,29 +1,124 @@
-import json
 import os
-from flask import Flask, request, jsonify, stream_with_context, Response
-from flask_cors import CORS
-from openai import OpenAI
+import orjson
+import asyncio
+from quart import Quart, request, jsonify, Response
+from quart_cors import cors
+from openai import AsyncOpenAI
 import uuid
+import itertools
+import math
+import hashlib
 import threading
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.targets import BaseTarget
 import docx
-import PyPDF2
+import zipfile
+from lxml import etree
+import fitz  # PyMuPDF
 from io import BytesIO
 import time
 from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+from collections import OrderedDict
 
-app = Flask(__name__)
-CORS(app)  # 允许跨域请求
+app = cors(Quart(__name__))  # 允许跨域请求
 
 # 配置
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB 文件大小限制
+app.config['RESPONSE_TIMEOUT'] = None  # 流式回复可能超过默认的60秒超时
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'docx', 'doc', 'md'}
+BATCH_PAGES = 20  # 每批发送给模型的页数
+DOCX_PARAGRAPHS_PER_PAGE = 30  # Word文档按段落数估算页数
+TEXT_LINES_PER_PAGE = 50  # 文本文件按行数估算页数
+CONVERSATION_CACHE_SIZE = 256  # 内存中最多缓存的对话数
+CONVERSATION_LOCK_STRIPES = 64  # 对话分段锁数量
+TASK_RETRY_AFTER = 30  # 任务队列已满时建议客户端重试的等待秒数
+REPLAY_CHUNK_CHARS = 512  # 重放已保存回复时每帧的字符数
+HISTORY_WINDOW = 20  # 原样发送给模型的最近消息数上限
+HISTORY_SUMMARY_STEP = 10  # 早期对话每累积多少条消息重新摘要一次
+HISTORY_SUMMARY_PROMPT = "请将以下学习对话压缩为简洁的摘要，保留教材的知识单元规划、已完成的单元、当前所处的学习阶段和知识单元、学员的薄弱点以及尚未解决的疑问。"
+MAX_UPLOADS_BYTES = 2 * 1024 * 1024 * 1024  # 上传目录容量上限，超出时删除最旧的文件
+MAX_TEXT_CACHE_BYTES = 512 * 1024 * 1024  # 提取文本缓存目录容量上限
+DOCX_NAMESPACE = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+DOCX_PARAGRAPH_TAG = DOCX_NAMESPACE + 'p'  # Word文档段落
+DOCX_RUN_TAG = DOCX_NAMESPACE + 'r'  # 文本段
+DOCX_TEXT_TAG = DOCX_NAMESPACE + 't'  # 文本节点
+DOCX_TAB_TAG = DOCX_NAMESPACE + 'tab'  # 制表符
+DOCX_BREAK_TAG = DOCX_NAMESPACE + 'br'  # 换行/分页符
+DOCX_CR_TAG = DOCX_NAMESPACE + 'cr'  # 回车
+DOCX_FALLBACK_TAG = '{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback'  # 兼容内容的备用副本
+DOCX_XML_PARSER = etree.XMLParser(resolve_entities=False)  # 禁用实体解析
+BATCH_DIGEST_PROMPT = "你是一名教材整理助手。请提炼以下教材片段的章节结构、核心概念和考试考点，保留原有的章节标题和顺序，以简洁的要点列表输出，不要添加片段中没有的内容。"
+
+# 容量受限的目录
+class BoundedFolder:
+    """
+    按修改时间（或最近一次使用时间）从旧到新记录目录中的文件，
+    总大小超出上限时删除最久未用的文件（始终保留最新的一个）
+    """
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.files = OrderedDict()  # 文件路径 -> 文件大小
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        
+        # 启动时登记已有文件并清理超出容量的部分
+        entries = []
+        for entry in os.scandir(folder):
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+        with self.lock:
+            for _, path, size in sorted(entries):
+                self.files[path] = size
+                self.total_bytes += size
+            self._evict()
+    
+    def add(self, path):
+        """登记新写入的文件，超出容量时删除最旧的文件"""
+        size = os.path.getsize(path)
+        with self.lock:
+            self.total_bytes -= self.files.pop(path, 0)
+            self.files[path] = size
+            self.total_bytes += size
+            self._evict()
+    
+    def touch(self, path):
+        """标记文件刚被使用，更新修改时间以便重启后仍按使用顺序清理"""
+        with self.lock:
+            if path in self.files:
+                self.files.move_to_end(path)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+    
+    def _evict(self):
+        """删除最旧的文件直到总大小不超过上限（调用方需持有锁）"""
+        while self.total_bytes > self.max_bytes and len(self.files) > 1:
+            path, size = self.files.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"清理文件失败: {str(e)}")
 
 # 创建上传目录
 upload_folder = os.path.join(os.path.dirname(__file__), 'uploads')
 if not os.path.exists(upload_folder):
     os.makedirs(upload_folder)
+uploads = BoundedFolder(upload_folder, MAX_UPLOADS_BYTES)
+
+# 创建提取文本缓存目录（按文件内容哈希缓存）
+text_cache_folder = os.path.join(os.path.dirname(__file__), 'uploads_cache')
+if not os.path.exists(text_cache_folder):
+    os.makedirs(text_cache_folder)
+text_cache = BoundedFolder(text_cache_folder, MAX_TEXT_CACHE_BYTES)
 
 # 任务状态枚举
 class TaskStatus(Enum):
@@ -32,12 +127,18 @@ class TaskStatus(Enum):
     COMPLETED = "completed"
     FAILED = "failed"
 
+class TaskQueueFull(Exception):
+    """排队和运行中的任务数已达上限"""
+
 # 全局任务管理器
 class TaskManager:
-    def __init__(self):
+    def __init__(self, max_concurrent_tasks=3, max_pending_tasks=16):
         self.tasks = {}
         self.lock = threading.Lock()
-        self.executor = ThreadPoolExecutor(max_workers=3)  # 限制并发任务数
+        self.max_concurrent_tasks = max_concurrent_tasks  # 限制并发任务数
+        self.max_pending_tasks = max_pending_tasks  # 限制排队和运行中的任务总数
+        self.semaphore = None  # 在事件循环中首次提交任务时创建
+        self.running = set()  # 持有运行中任务的引用，避免被垃圾回收
     
     def create_task(self, task_id, task_type, **kwargs):
         """创建新任务"""
@@ -56,7 +157,7 @@ class TaskManager:
         return task_id
     
     def update_task(self, task_id, **updates):
-        """更新任务状态"""
+        """更新任务状态，多个字段请在一次调用中传入"""
         with self.lock:
             if task_id in self.tasks:
                 self.tasks[task_id].update(updates)
@@ -67,165 +168,305 @@ class TaskManager:
         with self.lock:
             return self.tasks.get(task_id, None)
     
+    def is_full(self):
+        """排队和运行中的任务数是否已达上限"""
+        return len(self.running) >= self.max_pending_tasks
+
     def submit_task(self, task_id, func, *args, **kwargs):
-        """提交异步任务"""
-        def task_wrapper():
-            try:
-                self.update_task(task_id, status=TaskStatus.PROCESSING, progress=10)
-                result = func(*args, **kwargs)
-                self.update_task(task_id, 
-                               status=TaskStatus.COMPLETED, 
-                               progress=100, 
-                               result=result)
-                return result
-            except Exception as e:
-                self.update_task(task_id, 
-                               status=TaskStatus.FAILED, 
-                               progress=0, 
-                               error=str(e))
-                raise e
+        """
+        提交异步任务（需在事件循环中调用）
+        :param func: 协程函数
+        :raises TaskQueueFull: 排队和运行中的任务数已达上限
+        """
+        if self.is_full():
+            raise TaskQueueFull(f'排队和运行中的任务数已达上限: {self.max_pending_tasks}')
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrent_tasks)
+
+        async def task_wrapper():
+            async with self.semaphore:
+                try:
+                    self.update_task(task_id, status=TaskStatus.PROCESSING, progress=10)
+                    result = await func(*args, **kwargs)
+                    self.update_task(task_id, 
+                                   status=TaskStatus.COMPLETED, 
+                                   progress=100, 
+                                   result=result)
+                    return result
+                except Exception as e:
+                    self.update_task(task_id, 
+                                   status=TaskStatus.FAILED, 
+                                   progress=0, 
+                                   error=str(e))
+                    raise e
         
-        future = self.executor.submit(task_wrapper)
-        return future
+        task = asyncio.ensure_future(task_wrapper())
+        self.running.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+    
+    def _task_done(self, task):
+        """任务结束后移除引用；失败状态已记录，取出异常以免事件循环报告未处理的异常"""
+        self.running.discard(task)
+        if not task.cancelled():
+            task.exception()
 
 # 创建全局任务管理器
 task_manager = TaskManager()
 
-def allowed_file(filename):
-    """检查文件扩展名是否允许"""
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+# 文本提取线程池，模型调用走异步IO，线程池只用于文件文本提取
+extraction_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
 
-def extract_text_from_file(file_path, filename):
-    """从不同类型的文件中提取文本内容"""
-    file_ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
-    
+# 文件分析回复的流式缓冲
+class AnalysisStream:
+    """
+    分析任务边生成边追加回复片段，
+    /api/analyze-stream 的请求可在任意时刻接入并从第一个片段开始读取
+    """
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.condition = asyncio.Condition()
+
+    async def append(self, content):
+        """追加一个回复片段"""
+        async with self.condition:
+            self.chunks.append(content)
+            self.condition.notify_all()
+
+    async def finish(self, error=None):
+        """标记回复结束"""
+        async with self.condition:
+            self.done = True
+            self.error = error
+            self.condition.notify_all()
+
+    async def iter_chunks(self):
+        """依次产出回复片段，直到回复结束"""
+        index = 0
+        while True:
+            async with self.condition:
+                await self.condition.wait_for(lambda: index < len(self.chunks) or self.done)
+                chunks = self.chunks[index:]
+                done = self.done
+            index += len(chunks)
+            for chunk in chunks:
+                yield chunk
+            if done:
+                return
+
+# 正在进行的文件分析，键为对话ID
+analysis_streams = {}
+
+def task_queue_full_response():
+    """任务队列已满时的429响应"""
+    return jsonify({'error': '当前分析任务较多，请稍后重试'}), 429, {'Retry-After': str(TASK_RETRY_AFTER)}
+
+def sse(obj):
+    """编码一条SSE消息"""
+    return b"data: " + orjson.dumps(obj) + b"\n\n"
+
+# 内容片段SSE消息的固定前后缀，逐token推送时只需编码内容本身
+SSE_CONTENT_PREFIX = b'data: {"content":'
+SSE_CONTENT_SUFFIX = b'}\n\n'
+
+def sse_content(content):
+    """编码一条内容片段SSE消息，与 sse({'content': content}) 输出相同"""
+    return SSE_CONTENT_PREFIX + orjson.dumps(content) + SSE_CONTENT_SUFFIX
+
+def _get_ext(filename):
+    """获取小写的文件扩展名，没有扩展名时返回空字符串"""
+    i = filename.rfind('.')
+    return filename[i + 1:].lower() if i >= 0 else ''
+
+class UploadFileTarget(BaseTarget):
+    """
+    上传文件的流式接收目标
+    文件名在解析到multipart头部时才能确定，此时再检查扩展名，
+    支持的文件内容收集到内存中，直接用于文本提取
+    """
+    def __init__(self):
+        super().__init__()
+        self.ext = ''
+        self.buffer = None
+        self.sha256 = hashlib.sha256()  # 边接收边计算内容哈希，用于提取文本缓存
+        self.completed = False
+
+    def on_start(self):
+        self.ext = _get_ext(self.multipart_filename or '')
+        if self.ext in ALLOWED_EXTENSIONS:
+            self.buffer = BytesIO()
+
+    def on_data_received(self, chunk):
+        if self.buffer is not None:
+            self.buffer.write(chunk)
+            self.sha256.update(chunk)
+
+    def on_finish(self):
+        self.completed = True
+
+    def discard_incomplete(self):
+        """请求体不完整时丢弃收到一半的文件内容"""
+        if not self.completed:
+            self.buffer = None
+
+    def save(self, file_path):
+        """将文件内容保存到磁盘"""
+        with open(file_path, 'wb') as f:
+            f.write(self.buffer.getbuffer())
+
+def _iter_batches(units, units_per_batch):
+    """将文本单元（页、段落或行）按批次拼接"""
+    total = max(1, math.ceil(len(units) / units_per_batch))
+    for index, start in enumerate(range(0, len(units), units_per_batch)):
+        yield index + 1, total, '\n'.join(units[start:start + units_per_batch])
+
+def _extract_txt(buf, batch_pages):
+    """文本文件，按行数估算页数"""
+    lines = buf.getvalue().decode('utf-8').splitlines()
+    return _iter_batches(lines, batch_pages * TEXT_LINES_PER_PAGE)
+
+def _extract_docx(buf, batch_pages):
+    """Word文档，直接解析 word/document.xml 中的段落文本，按段落数估算页数"""
     try:
-        if file_ext == 'txt' or file_ext == 'md':
-            # 文本文件
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return f.read()
-        elif file_ext == 'docx':
-            # Word文档
-            doc = docx.Document(file_path)
-            text = []
-            for paragraph in doc.paragraphs:
-                text.append(paragraph.text)
-            return '\n'.join(text)
-        elif file_ext == 'pdf':
-            # PDF文件
-            text = []
-            with open(file_path, 'rb') as f:
-                pdf_reader = PyPDF2.PdfReader(f)
-                for page in pdf_reader.pages:
-                    text.append(page.extract_text())
-            return '\n'.join(text)
+        with zipfile.ZipFile(buf) as z:
+            root = etree.fromstring(z.read('word/document.xml'), DOCX_XML_PARSER)
+    except (KeyError, zipfile.BadZipFile, etree.XMLSyntaxError):
+        # 结构特殊的文档回退到 python-docx
+        buf.seek(0)
+        doc = docx.Document(buf)
+        paragraphs = [paragraph.text for paragraph in doc.paragraphs]
+        return _iter_batches(paragraphs, batch_pages * DOCX_PARAGRAPHS_PER_PAGE)
+
+    paragraphs = []
+    _collect_docx_paragraphs(root, paragraphs, None)
+    return _iter_batches([''.join(parts) for parts in paragraphs], batch_pages * DOCX_PARAGRAPHS_PER_PAGE)
+
+def _collect_docx_paragraphs(element, paragraphs, parts):
+    """
+    按文档顺序收集段落文本片段
+    文本框等嵌套段落单独成段，排在所在段落之后，不拆分所在段落；
+    mc:Fallback 是 mc:Choice 的重复副本，直接跳过
+    """
+    for child in element:
+        tag = child.tag
+        if tag == DOCX_FALLBACK_TAG:
+            continue
+        if tag == DOCX_PARAGRAPH_TAG:
+            child_parts = []
+            paragraphs.append(child_parts)
+            _collect_docx_paragraphs(child, paragraphs, child_parts)
+        elif parts is None:
+            _collect_docx_paragraphs(child, paragraphs, parts)
+        elif tag == DOCX_TEXT_TAG:
+            parts.append(child.text or '')
+        elif element.tag != DOCX_RUN_TAG:
+            # 段落格式中的制表位定义等不是正文内容
+            _collect_docx_paragraphs(child, paragraphs, parts)
+        elif tag == DOCX_TAB_TAG:
+            parts.append('\t')
+        elif tag == DOCX_BREAK_TAG or tag == DOCX_CR_TAG:
+            parts.append('\n')
         else:
-            return None
+            _collect_docx_paragraphs(child, paragraphs, parts)
+
+def _extract_pdf(buf, batch_pages):
+    """PDF文件，需要密码才能打开的加密文件不提取内容"""
+    with fitz.open(stream=buf.getvalue(), filetype='pdf') as doc:
+        if doc.needs_pass and not doc.authenticate(''):
+            return
+        total = max(1, math.ceil(len(doc) / batch_pages))
+        for index, start in enumerate(range(0, len(doc), batch_pages)):
+            end = min(start + batch_pages, len(doc))
+            yield index + 1, total, '\n'.join(doc.load_page(i).get_text("text") for i in range(start, end))
+
+# 各文件类型的文本提取函数：(文件内容, 每批页数) -> 产出 (已完成批数, 总批数, 批次文本) 的迭代器
+EXTRACTORS = {
+    'txt': _extract_txt,
+    'md': _extract_txt,
+    'docx': _extract_docx,
+    'pdf': _extract_pdf,
+}
+
+def iter_text_batches(buf, file_ext, batch_pages=BATCH_PAGES):
+    """
+    按页分批提取文件文本内容
+    :param buf: 文件内容（BytesIO）
+    :param file_ext: 小写的文件扩展名
+    :param batch_pages: 每批包含的页数，Word和文本文件按段落/行数估算页数
+    :return: 生成器，依次产出 (已完成批数, 总批数, 批次文本)，跳过空白批次
+    """
+    extractor = EXTRACTORS.get(file_ext)
+    if extractor is None:
+        return
+
+    for done, total, text in extractor(buf, batch_pages):
+        if text.strip():
+            yield done, total, text
+
+async def prefetch_batches(batches):
+    """
+    在提取线程池中预取下一批文本，使文本提取与模型调用重叠进行
+    同一时刻只有一个线程推进 batches，PyMuPDF 文档对象不会被并发访问
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(extraction_executor, next, batches, None)
+    while True:
+        batch = await future
+        if batch is None:
+            return
+        future = loop.run_in_executor(extraction_executor, next, batches, None)
+        yield batch
+
+def _text_cache_path(content_hash, file_ext):
+    """提取文本缓存路径，同一内容按不同文件类型提取的结果分开缓存"""
+    return os.path.join(text_cache_folder, f'{content_hash}.{file_ext}.json')
+
+def load_cached_text_batches(content_hash, file_ext):
+    """读取缓存的文本批次，未命中时返回None"""
+    cache_path = _text_cache_path(content_hash, file_ext)
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, 'rb') as f:
+            batches = [tuple(batch) for batch in orjson.loads(f.read())]
     except Exception as e:
-        print(f"提取文件内容失败: {str(e)}")
+        print(f"读取文本缓存失败: {str(e)}")
         return None
+    # 命中的缓存移到最后，经常重复上传的教材不会先被清理
+    text_cache.touch(cache_path)
+    return batches
+
+def iter_cached_text_batches(buf, file_ext, content_hash):
+    """
+    按内容哈希复用提取结果的 iter_text_batches
+    未命中缓存时正常提取，全部批次提取完成后写入缓存
+    """
+    cached_batches = load_cached_text_batches(content_hash, file_ext)
+    if cached_batches is not None:
+        yield from cached_batches
+        return
+
+    extracted = []
+    for batch in iter_text_batches(buf, file_ext):
+        extracted.append(batch)
+        yield batch
+
+    cache_path = _text_cache_path(content_hash, file_ext)
+    temp_path = f'{cache_path}.{uuid.uuid4()}.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(orjson.dumps(extracted))
+        os.replace(temp_path, cache_path)
+        text_cache.add(cache_path)
+    except Exception as e:
+        print(f"写入文本缓存失败: {str(e)}")
 
 # 初始化学习导师agent
 class CurriculumDrivenLearningTutor:
-    def __init__(self, api_key, base_url, model_name='qwen-turbo'):
-        """
-        初始化学习导师agent
-        :param api_key: 阿里云百炼API密钥
-        :param base_url: API基础URL
-        :param model_name: 使用的模型名称
-        """
-        self.client = OpenAI(
-            api_key=api_key,
-            base_url=base_url
-        )
-        self.model_name = model_name
-        self.conversations = {}  # 存储所有对话历史
-        self.conversations_file = os.path.join(os.path.dirname(__file__), 'conversations.json')
-        self.lock = threading.Lock()  # 添加线程锁
-        self.load_conversations()
-        
-    def create_conversation(self):
-        """
-        创建新对话
-        :return: 对话ID
-        """
-        with self.lock:
-            conversation_id = str(uuid.uuid4())
-            self.conversations[conversation_id] = []
-            self.save_conversations()
-            return conversation_id
-        
-    def start_conversation(self, conversation_id, user_input):
-        """
-        开始对话
-        :param conversation_id: 对话ID
-        :param user_input: 用户输入
-        :return: 模型回复
-        """
-        with self.lock:
-            # 获取或创建对话历史
-            if conversation_id not in self.conversations:
-                self.conversations[conversation_id] = []
-                
-            # 添加用户输入到历史记录
-            self.conversations[conversation_id].append({'role': 'user', 'content': user_input})
-            
-            # 构建系统提示
-            system_prompt = self._build_system_prompt()
-            
-            # 准备消息列表
-            messages = [{'role': 'system', 'content': system_prompt}] + self.conversations[conversation_id]
-        
-        # 调用模型
-        try:
-            response = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=messages,
-                temperature=0.7,
-                stream=True  # 启用流式输出
-            )
-            
-            # 返回流式响应
-            return response
-        except Exception as e:
-            return f"调用模型失败: {str(e)}"
-    
-    def add_assistant_message(self, conversation_id, content):
-        """添加助手回复到对话历史"""
-        with self.lock:
-            if conversation_id in self.conversations:
-                self.conversations[conversation_id].append({
-                    'role': 'assistant',
-                    'content': content
-                })
-                self.save_conversations()
-    
-    def save_conversations(self):
-        """保存对话历史到文件"""
-        try:
-            with open(self.conversations_file, 'w', encoding='utf-8') as f:
-                json.dump(self.conversations, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            print(f"保存对话历史失败: {str(e)}")
-
-    def load_conversations(self):
-        """从文件加载对话历史"""
-        try:
-            if os.path.exists(self.conversations_file):
-                with open(self.conversations_file, 'r', encoding='utf-8') as f:
-                    self.conversations = json.load(f)
-            else:
-                self.conversations = {}
-        except Exception as e:
-            print(f"加载对话历史失败: {str(e)}")
-            self.conversations = {}
-    
-    def _build_system_prompt(self):
-        """
-        构建系统提示词
-        """
-        system_prompt = """# Role: 课程主导型学习导师 (Curriculum-Driven Learning Tutor)
+    # 系统提示词为常量，类定义时构建一次
+    SYSTEM_PROMPT = """# Role: 课程主导型学习导师 (Curriculum-Driven Learning Tutor)
 
 ## Profile:
 - Author: Qwen
@@ -285,8 +526,294 @@ class CurriculumDrivenLearningTutor:
 2. **鼓励**: 最后给予我鼓励，例如："恭喜你完成了本次学习！坚持下去，胜利就在眼前！"
 
 请严格按照以上角色设定和工作流程与用户交互。"""
+
+    def __init__(self, api_key, base_url, model_name='qwen-turbo'):
+        """
+        初始化学习导师agent
+        :param api_key: 阿里云百炼API密钥
+        :param base_url: API基础URL
+        :param model_name: 使用的模型名称
+        """
+        self.client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url
+        )
+        self.model_name = model_name
+        self.system_message = {'role': 'system', 'content': self.SYSTEM_PROMPT}  # 复用的系统提示消息
+        self.conversations = OrderedDict()  # 最近使用的对话历史（LRU缓存）
+        self.history_summaries = {}  # 早期对话摘要：对话ID -> (摘要覆盖的消息数, 摘要)，随对话一起淘汰，同时保存到文件
+        self.conversations_dir = os.path.join(os.path.dirname(__file__), 'conversations')
+        self.cache_lock = threading.Lock()  # 仅保护LRU缓存结构，不在持有期间做文件读写
+        # 分段锁：不同对话映射到不同的锁，互不相关的对话可以并行读写
+        self.conversation_locks = [threading.Lock() for _ in range(CONVERSATION_LOCK_STRIPES)]
+        os.makedirs(self.conversations_dir, exist_ok=True)
+        self.migrate_legacy_conversations()
+        
+    def create_conversation(self, conversation_id=None):
+        """
+        创建新对话
+        :param conversation_id: 预先生成的对话ID，默认新生成
+        :return: 对话ID
+        """
+        conversation_id = conversation_id or str(uuid.uuid4())
+        with self._conversation_lock(conversation_id):
+            self._cache_conversation(conversation_id, [])
+            self.save_messages(conversation_id, [])
+        return conversation_id
+        
+    async def start_conversation(self, conversation_id, user_input):
+        """
+        开始对话
+        :param conversation_id: 对话ID
+        :param user_input: 用户输入
+        :return: 模型回复
+        """
+        if not self._is_valid_conversation_id(conversation_id):
+            return "无效的对话ID"
+
+        with self._conversation_lock(conversation_id):
+            # 获取或创建对话历史
+            history = self._get_conversation(conversation_id)
+            if history is None:
+                history = []
+                self._cache_conversation(conversation_id, history)
+                
+            # 添加用户输入到历史记录
+            self._add_message(conversation_id, history, 'user', user_input)
+            window = self._message_window(conversation_id, history)
+        
+        # 调用模型
+        try:
+            # 准备消息列表
+            messages = await self.build_messages(conversation_id, window)
+            
+            response = await self.client.chat.completions.create(
+                model=self.model_name,
+                messages=messages,
+                temperature=0.7,
+                stream=True  # 启用流式输出
+            )
+            
+            # 返回流式响应
+            return response
+        except Exception as e:
+            return f"调用模型失败: {str(e)}"
+    
+    def message_window(self, conversation_id):
+        """截取构建消息列表所需的对话片段，对话不存在时返回None"""
+        with self._conversation_lock(conversation_id):
+            history = self._get_conversation(conversation_id)
+            if history is None:
+                return None
+            return self._message_window(conversation_id, history)
+
+    async def build_messages(self, conversation_id, window):
+        """
+        构建发送给模型的消息列表：系统提示 + 早期对话摘要 + 最近的对话
+        :param window: message_window 截取的对话片段
+        """
+        summary, pending, summarized_count, recent = window
+        if pending:
+            # 每次最多摘要 HISTORY_SUMMARY_STEP 条消息，没有可用摘要时也不会一次发送全部早期对话
+            for start in range(0, len(pending), HISTORY_SUMMARY_STEP):
+                summary = await self._summarize_history(summary, pending[start:start + HISTORY_SUMMARY_STEP])
+            with self.cache_lock:
+                # 摘要期间对话可能已被淘汰，此时不再保存，以免摘要脱离对话残留在内存中
+                stored = (conversation_id in self.conversations
+                          and self.history_summaries.get(conversation_id, (0, None))[0] < summarized_count)
+                if stored:
+                    self.history_summaries[conversation_id] = (summarized_count, summary)
+            if stored:
+                self.save_history_summary(conversation_id, summarized_count, summary)
         
-        return system_prompt
+        messages = [self.system_message]
+        if summary is not None:
+            messages.append({'role': 'system', 'content': f'此前对话摘要：\n{summary}'})
+        return messages + recent
+
+    def _message_window(self, conversation_id, history):
+        """
+        截取构建消息列表所需的对话片段（调用方需持有该对话的锁）
+        超出 HISTORY_WINDOW 的早期对话每 HISTORY_SUMMARY_STEP 条消息补充摘要一次，
+        已有摘要时只复制最近的消息和待补充摘要的消息，开销与对话总长度无关
+        :return: (已有摘要, 待补充摘要的消息, 摘要覆盖的消息数, 最近的消息)
+        """
+        summarized_count = 0
+        if len(history) > HISTORY_WINDOW:
+            summarized_count = math.ceil((len(history) - HISTORY_WINDOW) / HISTORY_SUMMARY_STEP) * HISTORY_SUMMARY_STEP
+        
+        with self.cache_lock:
+            previous_count, summary = self.history_summaries.get(conversation_id, (0, None))
+        if previous_count > summarized_count:
+            previous_count, summary = 0, None
+        
+        pending = history[previous_count:summarized_count]
+        return summary, pending, summarized_count, history[summarized_count:]
+
+    async def _summarize_history(self, previous_summary, messages):
+        """在已有摘要的基础上摘要新增的早期对话"""
+        if previous_summary is not None:
+            text = f'此前对话摘要：\n{previous_summary}\n\n后续对话：\n{self._format_transcript(messages)}'
+        else:
+            text = self._format_transcript(messages)
+        
+        response = await self.client.chat.completions.create(
+            model=self.model_name,
+            messages=[
+                {'role': 'system', 'content': HISTORY_SUMMARY_PROMPT},
+                {'role': 'user', 'content': text}
+            ],
+            temperature=0.3,
+            stream=False
+        )
+        return response.choices[0].message.content
+
+    @staticmethod
+    def _format_transcript(messages):
+        """将对话片段格式化为摘要用的文本"""
+        speakers = {'user': '学员', 'assistant': '导师'}
+        return '\n\n'.join(f"{speakers.get(message['role'], message['role'])}：{message['content']}" for message in messages)
+    
+    def get_conversation(self, conversation_id):
+        """获取对话历史，对话不存在时返回None"""
+        with self._conversation_lock(conversation_id):
+            return self._get_conversation(conversation_id)
+
+    def add_user_message(self, conversation_id, content):
+        """添加用户消息到对话历史"""
+        with self._conversation_lock(conversation_id):
+            history = self._get_conversation(conversation_id)
+            if history is not None:
+                self._add_message(conversation_id, history, 'user', content)
+
+    def add_assistant_message(self, conversation_id, content):
+        """添加助手回复到对话历史"""
+        with self._conversation_lock(conversation_id):
+            history = self._get_conversation(conversation_id)
+            if history is not None:
+                self._add_message(conversation_id, history, 'assistant', content)
+    
+    def save_messages(self, conversation_id, messages):
+        """以追加方式保存消息到对话文件（JSONL，每行一条消息）"""
+        try:
+            with open(self._conversation_path(conversation_id), 'ab') as f:
+                f.write(b''.join(orjson.dumps(message) + b'\n' for message in messages))
+        except Exception as e:
+            print(f"保存对话历史失败: {str(e)}")
+
+    def save_history_summary(self, conversation_id, count, summary):
+        """保存早期对话摘要到对话文件旁，对话被淘汰或服务重启后无需重新摘要"""
+        summary_path = self._summary_path(conversation_id)
+        temp_path = f'{summary_path}.{uuid.uuid4()}.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(orjson.dumps({'count': count, 'summary': summary}))
+            os.replace(temp_path, summary_path)
+        except Exception as e:
+            print(f"保存对话摘要失败: {str(e)}")
+
+    def load_history_summary(self, conversation_id):
+        """从文件加载早期对话摘要，没有摘要时返回None"""
+        summary_path = self._summary_path(conversation_id)
+        if not os.path.exists(summary_path):
+            return None
+        try:
+            with open(summary_path, 'rb') as f:
+                data = orjson.loads(f.read())
+            return data['count'], data['summary']
+        except Exception as e:
+            print(f"加载对话摘要失败: {str(e)}")
+            return None
+
+    def load_conversation(self, conversation_id):
+        """从文件加载单个对话历史，对话不存在时返回None"""
+        if not self._is_valid_conversation_id(conversation_id):
+            return None
+        conversation_path = self._conversation_path(conversation_id)
+        if not os.path.exists(conversation_path):
+            return None
+        messages = []
+        try:
+            with open(conversation_path, 'rb') as f:
+                for line in f:
+                    try:
+                        messages.append(orjson.loads(line))
+                    except orjson.JSONDecodeError:
+                        # 跳过写入中断留下的残缺行
+                        continue
+        except Exception as e:
+            print(f"加载对话历史失败: {str(e)}")
+        return messages
+
+    def migrate_legacy_conversations(self):
+        """将旧版 conversations.json 拆分为逐对话的JSONL文件"""
+        legacy_file = os.path.join(os.path.dirname(__file__), 'conversations.json')
+        if not os.path.exists(legacy_file):
+            return
+        try:
+            with open(legacy_file, 'rb') as f:
+                conversations = orjson.loads(f.read())
+            for conversation_id, messages in conversations.items():
+                if self._is_valid_conversation_id(conversation_id):
+                    self.save_messages(conversation_id, messages)
+            os.replace(legacy_file, legacy_file + '.migrated')
+        except Exception as e:
+            print(f"迁移对话历史失败: {str(e)}")
+
+    def _get_conversation(self, conversation_id):
+        """获取对话历史，未缓存时从文件读取（调用方需持有该对话的锁）"""
+        with self.cache_lock:
+            messages = self.conversations.get(conversation_id)
+            if messages is not None:
+                self.conversations.move_to_end(conversation_id)
+                return messages
+        messages = self.load_conversation(conversation_id)
+        if messages is not None:
+            summary = self.load_history_summary(conversation_id)
+            self._cache_conversation(conversation_id, messages)
+            if summary is not None:
+                with self.cache_lock:
+                    if conversation_id in self.conversations:
+                        self.history_summaries.setdefault(conversation_id, summary)
+        return messages
+
+    def _cache_conversation(self, conversation_id, messages):
+        """
+        缓存对话历史，超出容量时淘汰最久未使用的对话
+        消息在追加时已写入文件，淘汰时无需回写
+        """
+        with self.cache_lock:
+            self.conversations[conversation_id] = messages
+            self.conversations.move_to_end(conversation_id)
+            while len(self.conversations) > CONVERSATION_CACHE_SIZE:
+                evicted_id, _ = self.conversations.popitem(last=False)
+                self.history_summaries.pop(evicted_id, None)
+
+    def _add_message(self, conversation_id, history, role, content):
+        """追加一条消息到对话历史和对话文件（调用方需持有该对话的锁）"""
+        message = {'role': role, 'content': content}
+        history.append(message)
+        self.save_messages(conversation_id, [message])
+
+    def _conversation_lock(self, conversation_id):
+        """对话对应的分段锁"""
+        return self.conversation_locks[hash(conversation_id) % len(self.conversation_locks)]
+
+    def _conversation_path(self, conversation_id):
+        """对话文件路径"""
+        return os.path.join(self.conversations_dir, f'{conversation_id}.jsonl')
+
+    def _summary_path(self, conversation_id):
+        """早期对话摘要文件路径"""
+        return os.path.join(self.conversations_dir, f'{conversation_id}.summary.json')
+
+    @staticmethod
+    def _is_valid_conversation_id(conversation_id):
+        """对话ID必须是UUID，防止拼接出任意文件路径"""
+        try:
+            return str(uuid.UUID(conversation_id)) == conversation_id
+        except (ValueError, TypeError, AttributeError):
+            return False
 
 # 从环境变量获取API配置
 def get_api_config():
@@ -305,7 +832,7 @@ tutor = CurriculumDrivenLearningTutor(
 )
 
 @app.route('/api/new-conversation', methods=['POST'])
-def new_conversation():
+async def new_conversation():
     """
     创建新对话
     """
@@ -316,11 +843,13 @@ def new_conversation():
     })
 
 @app.route('/api/chat', methods=['POST'])
-def chat():
+async def chat():
     """
     处理聊天消息
     """
-    data = request.json
+    data = await request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': '缺少必要参数'}), 400
     conversation_id = data.get('conversation_id')
     user_message = data.get('message')
     
@@ -328,68 +857,81 @@ def chat():
         return jsonify({'error': '缺少必要参数'}), 400
     
     # 使用流式响应返回结果
-    def generate():
-        response = tutor.start_conversation(conversation_id, user_message)
+    async def generate():
+        response = await tutor.start_conversation(conversation_id, user_message)
         if isinstance(response, str):  # 错误消息
-            yield f"data: {json.dumps({'error': response})}\n\n"
+            yield sse({'error': response})
             return
             
         # 流式输出模型回复
         full_response = ""
-        for chunk in response:
+        async for chunk in response:
             if chunk.choices[0].delta.content:
                 content = chunk.choices[0].delta.content
                 full_response += content
-                yield f"data: {json.dumps({'content': content})}\n\n"
+                yield sse_content(content)
         
         # 将完整回复添加到对话历史
-        tutor.conversations[conversation_id].append({
-            'role': 'assistant',
-            'content': full_response
-        })
-        tutor.save_conversations()
-        yield f"data: {json.dumps({'done': True})}\n\n"
+        tutor.add_assistant_message(conversation_id, full_response)
+        yield sse({'done': True})
     
-    return Response(stream_with_context(generate()), content_type='text/event-stream')
+    return Response(generate(), content_type='text/event-stream')
+
+async def digest_text_batch(text, done, total):
+    """提炼单批教材内容的要点，避免把整本教材塞进同一个提示词"""
+    response = await tutor.client.chat.completions.create(
+        model=tutor.model_name,
+        messages=[
+            {'role': 'system', 'content': BATCH_DIGEST_PROMPT},
+            {'role': 'user', 'content': f'教材第{done}/{total}部分:\n\n{text}'}
+        ],
+        temperature=0.3,
+        stream=False
+    )
+    return response.choices[0].message.content
 
-def analyze_file_content_async(task_id, conversation_id, file_content):
-    """异步分析文件内容"""
+async def analyze_file_content_async(task_id, conversation_id, stream, batches):
+    """
+    异步分析文件内容
+    :param stream: 提交任务时登记在 analysis_streams 中的回复流
+    :param batches: iter_text_batches 产出的文本批次
+    """
+    error = None
     try:
-        # 更新进度：开始分析
-        task_manager.update_task(task_id, progress=30, status=TaskStatus.PROCESSING)
-        
+        # 逐批读取教材；多批次时先提炼每批要点，进度随实际完成的批次更新
+        batch_texts = []
+        async for done, total, text in prefetch_batches(batches):
+            if total == 1:
+                batch_texts.append(text)
+            else:
+                batch_texts.append(await digest_text_batch(text, done, total))
+            task_manager.update_task(task_id, progress=30 + int(60 * done / total))
+
+        if len(batch_texts) == 1:
+            file_content = batch_texts[0]
+        else:
+            file_content = '（教材篇幅较长，以下为按顺序分批整理的要点）\n\n' + '\n\n'.join(batch_texts)
+
         # 添加用户消息到对话历史
-        with tutor.lock:
-            tutor.conversations[conversation_id].append({
-                'role': 'user', 
-                'content': f'请分析以下教材内容:\n\n{file_content}'
-            })
-        
-        # 更新进度：准备调用AI
-        task_manager.update_task(task_id, progress=50)
-        
-        # 构建系统提示
-        system_prompt = tutor._build_system_prompt()
+        tutor.add_user_message(conversation_id, f'请分析以下教材内容:\n\n{file_content}')
         
         # 准备消息列表
-        messages = [{'role': 'system', 'content': system_prompt}] + tutor.conversations[conversation_id]
-        
-        # 更新进度：调用AI模型
-        task_manager.update_task(task_id, progress=70)
+        messages = await tutor.build_messages(conversation_id, tutor.message_window(conversation_id))
         
-        # 调用模型
-        response = tutor.client.chat.completions.create(
+        # 调用模型，回复片段边生成边推送给 /api/analyze-stream
+        response = await tutor.client.chat.completions.create(
             model=tutor.model_name,
             messages=messages,
             temperature=0.7,
-            stream=False
+            stream=True
         )
         
-        # 获取AI回复
-        ai_response = response.choices[0].message.content
-        
-        # 更新进度：保存结果
-        task_manager.update_task(task_id, progress=90)
+        ai_response = ""
+        async for chunk in response:
+            if chunk.choices[0].delta.content:
+                content = chunk.choices[0].delta.content
+                ai_response += content
+                await stream.append(content)
         
         # 添加AI回复到对话历史
         tutor.add_assistant_message(conversation_id, ai_response)
@@ -400,90 +942,150 @@ def analyze_file_content_async(task_id, conversation_id, file_content):
         }
         
     except Exception as e:
+        error = str(e)
         print(f"异步分析文件内容失败: {str(e)}")
         raise e
+    finally:
+        await stream.finish(error)
+        analysis_streams.pop(conversation_id, None)
 
 @app.route('/api/upload', methods=['POST'])
-def upload_file():
+async def upload_file():
     """
     文件上传接口 - 异步处理版本
     """
     try:
-        if 'file' not in request.files:
+        # 任务队列已满时不再接收文件
+        if task_manager.is_full():
+            return task_queue_full_response()
+        
+        # 非 multipart 请求（或缺少 boundary）中不可能有文件
+        if request.mimetype != 'multipart/form-data' or 'boundary' not in request.mimetype_params:
+            return jsonify({'error': '没有文件'}), 400
+
+        # 边接收请求体边解析multipart，文件内容收集到内存中
+        target = UploadFileTarget()
+        parser = StreamingFormDataParser(headers=request.headers)
+        parser.register('file', target)
+        received = 0
+        try:
+            async for chunk in request.body:
+                # 分块传输的请求体没有 Content-Length，需边接收边检查大小
+                received += len(chunk)
+                if received > app.config['MAX_CONTENT_LENGTH']:
+                    raise RequestEntityTooLarge()
+                parser.data_received(chunk)
+        except RequestEntityTooLarge:
+            target.buffer = None
+            return jsonify({'error': '文件过大'}), 413
+        finally:
+            target.discard_incomplete()
+
+        if target.multipart_filename is None:
             return jsonify({'error': '没有文件'}), 400
         
-        file = request.files['file']
-        if file.filename == '':
+        if target.multipart_filename == '':
             return jsonify({'error': '没有选择文件'}), 400
         
-        # 检查文件类型
-        if not allowed_file(file.filename):
+        # 检查文件类型（不支持的类型不会被接收）
+        if target.buffer is None:
             return jsonify({'error': f'不支持的文件类型。支持的类型: {", ".join(ALLOWED_EXTENSIONS)}'}), 400
         
         # 安全的文件名
-        secure_name = secure_filename(file.filename)
+        secure_name = secure_filename(target.multipart_filename)
         filename = f"{uuid.uuid4()}_{secure_name}"
         file_path = os.path.join(upload_folder, filename)
+        file_size = target.buffer.getbuffer().nbytes
         
-        # 保存文件
-        file.save(file_path)
+        # 相同内容的文件直接复用缓存的提取结果
+        batches = iter_cached_text_batches(
+            target.buffer, target.ext, target.sha256.hexdigest())
         
-        # 提取文件内容
-        file_content = extract_text_from_file(file_path, file.filename)
+        # 直接从内存提取第一批文件内容，其余批次交给异步任务逐批处理
+        try:
+            first_batch = await asyncio.get_running_loop().run_in_executor(
+                extraction_executor, next, batches, None)
+        except Exception as e:
+            print(f"提取文件内容失败: {str(e)}")
+            first_batch = None
+        file_content = first_batch[2] if first_batch else None
         
-        # 创建新对话
-        conversation_id = tutor.create_conversation()
+        # 未提取到内容时只创建对话，不启动分析
+        if not file_content:
+            batches.close()
+            conversation_id = tutor.create_conversation()
+            return jsonify({
+                'message': '文件上传成功，但未能提取到文本内容',
+                'filename': filename,
+                'size': file_size,
+                'path': None,  # 未提取到内容的文件不保存
+                'conversation_id': conversation_id,
+                'has_content': False,
+                'status': 'completed'
+            })
         
-        # 创建分析任务
-        task_id = str(uuid.uuid4())
+        # 先保存文件留档，写盘放到线程池中，不阻塞事件循环
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(extraction_executor, target.save, file_path)
+        except Exception:
+            batches.close()
+            raise
         
-        # 如果成功提取到文件内容，启动异步分析
-        if file_content and file_content.strip():
-            # 创建任务
-            task_manager.create_task(
-                task_id=task_id,
-                task_type='file_analysis',
-                filename=filename,
-                conversation_id=conversation_id,
-                file_size=os.path.getsize(file_path)
-            )
-            
-            # 提交异步任务
+        # 再提交异步任务，提交失败时删除已保存的文件，不留下对话和任务
+        conversation_id = str(uuid.uuid4())
+        task_id = str(uuid.uuid4())
+        stream = AnalysisStream()
+        try:
             task_manager.submit_task(
                 task_id,
                 analyze_file_content_async,
                 task_id,
                 conversation_id,
-                file_content
+                stream,
+                itertools.chain([first_batch], batches)
             )
-            
-            return jsonify({
-                'message': '文件上传成功，正在分析中',
-                'filename': filename,
-                'size': os.path.getsize(file_path),
-                'path': file_path,
-                'content_preview': file_content[:500] + '...' if len(file_content) > 500 else file_content,
-                'conversation_id': conversation_id,
-                'task_id': task_id,
-                'has_content': True,
-                'status': 'processing'
-            })
-        else:
-            return jsonify({
-                'message': '文件上传成功，但未能提取到文本内容',
-                'filename': filename,
-                'size': os.path.getsize(file_path),
-                'path': file_path,
-                'conversation_id': conversation_id,
-                'has_content': False,
-                'status': 'completed'
-            })
+        except TaskQueueFull:
+            # 提取和写盘期间任务队列可能已满
+            batches.close()
+            await loop.run_in_executor(extraction_executor, os.remove, file_path)
+            return task_queue_full_response()
+        
+        # 任务在下一次事件循环迭代才开始执行，此前同步完成以下登记
+        task_manager.create_task(
+            task_id=task_id,
+            task_type='file_analysis',
+            filename=filename,
+            conversation_id=conversation_id,
+            file_size=file_size
+        )
+        
+        # 提交时即登记回复流，任务排队期间 /api/analyze-stream 也能接入
+        analysis_streams[conversation_id] = stream
+        
+        # 创建新对话
+        tutor.create_conversation(conversation_id)
+        
+        # 登记留档文件，超出容量时在线程池中清理最旧的文件
+        await loop.run_in_executor(extraction_executor, uploads.add, file_path)
+        
+        return jsonify({
+            'message': '文件上传成功，正在分析中',
+            'filename': filename,
+            'size': file_size,
+            'path': file_path,
+            'content_preview': file_content[:500] + '...' if len(file_content) > 500 else file_content,
+            'conversation_id': conversation_id,
+            'task_id': task_id,
+            'has_content': True,
+            'status': 'processing'
+        })
         
     except Exception as e:
         return jsonify({'error': f'文件上传失败: {str(e)}'}), 500
 
 @app.route('/api/task/<task_id>', methods=['GET'])
-def get_task_status(task_id):
+async def get_task_status(task_id):
     """
     获取任务状态
     """
@@ -498,20 +1100,31 @@ def get_task_status(task_id):
     return jsonify(task_info)
 
 @app.route('/api/analyze-stream/<conversation_id>', methods=['GET'])
-def stream_analysis_result(conversation_id):
+async def stream_analysis_result(conversation_id):
     """
     流式获取分析结果
     """
-    def generate():
-        # 检查对话是否存在
-        if conversation_id not in tutor.conversations:
-            yield f"data: {json.dumps({'error': '对话不存在'})}\n\n"
+    async def generate():
+        # 分析进行中：转发模型生成的回复片段
+        stream = analysis_streams.get(conversation_id)
+        if stream is not None:
+            async for content in stream.iter_chunks():
+                yield sse_content(content)
+            if stream.error:
+                yield sse({'error': stream.error})
+            else:
+                yield sse({'done': True})
+            return
+        
+        # 分析已结束：获取对话历史并检查对话是否存在
+        messages = tutor.get_conversation(conversation_id)
+        if messages is None:
+            yield sse({'error': '对话不存在'})
             return
         
         # 获取最新的助手回复
-        messages = tutor.conversations[conversation_id]
         if not messages:
-            yield f"data: {json.dumps({'error': '暂无分析结果'})}\n\n"
+            yield sse({'error': '暂无分析结果'})
             return
         
         # 找到最后一条助手消息
@@ -522,21 +1135,16 @@ def stream_analysis_result(conversation_id):
                 break
         
         if not last_assistant_message:
-            yield f"data: {json.dumps({'error': '暂无AI回复'})}\n\n"
+            yield sse({'error': '暂无AI回复'})
             return
         
-        # 模拟流式输出已有的回复
+        # 按固定大小分帧发送已保存的回复
         content = last_assistant_message['content']
-        chunk_size = 50  # 每次发送50个字符
-        
-        for i in range(0, len(content), chunk_size):
-            chunk = content[i:i + chunk_size]
-            yield f"data: {json.dumps({'content': chunk})}\n\n"
-            time.sleep(0.1)  # 模拟流式延迟
-        
-        yield f"data: {json.dumps({'done': True})}\n\n"
+        for start in range(0, len(content), REPLAY_CHUNK_CHARS):
+            yield sse_content(content[start:start + REPLAY_CHUNK_CHARS])
+        yield sse({'done': True})
     
-    return Response(stream_with_context(generate()), content_type='text/event-stream')
+    return Response(generate(), content_type='text/event-stream')
 
 if __name__ == '__main__':
     app.run(debug=True, port=5000)